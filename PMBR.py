@@ -5,16 +5,23 @@ Paul de Fontenay, UPHUMMEL EPFL, 2025
 
 import numpy as np
 import csv
+import json
+import math
 import os
-from psychopy import visual, core, tools, event#, parallel
+from psychopy import visual, core, event#, parallel
+#import threading #for the trigger background worker, with parallel
+#from concurrent.futures import ThreadPoolExecutor
 from psychopy import gui
 from datetime import datetime
 from pathlib import Path
+from types import SimpleNamespace
+import functools
 import argparse
-import random
 import pandas as pd
 from psychopy.hardware import joystick
-import time
+from pyglet.window import key as pyglet_key
+from numba import njit
+import psyquartz
 
 
 #Get screen arguments
@@ -33,11 +40,66 @@ button_duration = 0.6 #max duration for button press
 x_size_increase = 0.2  #size inscrease for the joystick to push's image, x-axis
 y_size_increase = 0.2  #size inscrease for the joystick to push's image, y-axis
 RT_display_time = 5 #duration to display the mean reaction time at the end of the block
+warmup_frames = 30 #blank frames flipped before the ramp-up period
+expected_refresh_rate = 144 #Hz, minimum screen refresh rate, used to size the joystick position buffers if the refresh rate can't be measured
+x_axis = 0 #index of the x-axis in joystick.getAllAxes() (same axis as joystick.getX())
+y_axis = 1 #index of the y-axis in joystick.getAllAxes() (same axis as joystick.getY())
+movement_start_threshold = 0.005 #y-axis change between two samples marking the start of a joystick movement
+movement_end_threshold = -0.9 #y-axis position marking the end of a joystick movement (90% of y-axis)
+last_params_path = Path('lastParams_PMBR.json') #last parameters entered in the GUI
+log_dtype = np.dtype([('ID','U16'),('Session','U8'),('Run','i4'),('Trial','i4'),('Block','i4'),('TrialStart','f8'),
+                      ('RT_press','f8'),('RT_start_right','f8'),('RT_start_left','f8'),('RT_end_right','f8'),('RT_end_left','f8'),
+                      ('right_positions','O'),('left_positions','O'),('time','O')]) #columns of the runs file, one row per trial
 
 
+key_state = pyglet_key.KeyStateHandler() #keyboard state, pushed on the window handlers in the main routine
 
 
-'''def send_trigger(pin):
+def escape_pressed():
+    """
+    Returns True if the escape key is currently held down.
+
+    Reads the pyglet keyboard state (`key_state`), updated on each window event dispatch, so the
+    polling loops can check for a user stop without scanning the PsychoPy key buffer.
+    """
+    return key_state[pyglet_key.ESCAPE]
+
+
+
+class FastCountdown:
+    """
+    Countdown timer backed by psyquartz's Rust clock, used in the polling loops instead of `core.CountdownTimer`.
+
+    Exposes the same `getTime()` as `core.CountdownTimer`: the remaining time in seconds,
+    negative once the duration has elapsed.
+
+    Args:
+        duration (float): Duration of the countdown in seconds.
+    """
+
+    def __init__(self, duration):
+        self.clock = psyquartz.MonotonicClock()
+        self.duration = duration
+
+    def getTime(self):
+        return self.duration - self.clock.getTime()
+
+
+'''_trigger_executor = ThreadPoolExecutor(max_workers=1) #background worker setting the trigger pins back to low
+feedback_triggers = {'right': (7, 8), 'left': (5, 6)} #(correct, incorrect) joystick push trigger pins, for the pushed side
+_trigger_lock = threading.Lock() #guards the parallel port writes from the main and background threads
+
+
+def _delayed_low(pin):
+    """
+    Sets `pin` back to low (0) after 50 milliseconds. Runs on the trigger background thread.
+    """
+    psyquartz.sleep(0.05)
+    with _trigger_lock:
+        parallel.setPin(pin,0)
+
+
+def send_trigger(pin):
     """
     Sends a short digital trigger pulse through a specified pin on the parallel port.
     
@@ -45,6 +107,9 @@ RT_display_time = 5 #duration to display the mean reaction time at the end of th
     It is typically used to send event markers (triggers) to external devices (e.g., EEG systems, DAQ)
     at specific moments in an experiment.
 
+    The pin is set back to low from a background thread so the function returns immediately and
+    the caller can keep polling the joysticks and flipping the window. The event timestamp is the rising edge.
+
 
     Note:
         Only pin #2 is typically used for TI in this specific setup.
@@ -61,9 +126,9 @@ RT_display_time = 5 #duration to display the mean reaction time at the end of th
     Args:
         pin (int): The parallel port pin number to activate.
     """
-    parallel.setPin(pin,1) #could use setData() to simultaneously send triggers in different pins 
-    time.sleep(0.05)
-    parallel.setPin(pin,0)'''
+    with _trigger_lock:
+        parallel.setPin(pin,1) #could use setData() to simultaneously send triggers in different pins 
+    _trigger_executor.submit(_delayed_low, pin)'''
 
 
 
@@ -78,7 +143,7 @@ def get_parameters(skip_gui=False):
     to a file for future use. If `skip_gui` is True, it loads the last used parameters 
     directly from the file.
 
-    The parameter file used is 'lastParams_PMBR.pickle'.
+    The parameter file used is `last_params_path` ('lastParams_PMBR.json').
 
     Args:
         skip_gui (bool): If True, skip the GUI and use the last saved parameters.
@@ -92,9 +157,9 @@ def get_parameters(skip_gui=False):
             - 'NbTrials' (int): Number of trials per block
             - 'Set' (str): 'Standard' or 'Practice'
     """
-    try:
-        param_settings = tools.filetools.fromFile('lastParams_PMBR_.pickle')
-    except:
+    if last_params_path.exists():
+        param_settings = json.loads(last_params_path.read_text())
+    else:
         param_settings = [1,1,1,10,84, 'Standard']
    
     if not skip_gui:
@@ -109,7 +174,7 @@ def get_parameters(skip_gui=False):
         #If gui is canceled the task will quit
 
         if param_dialog.OK:
-            tools.filetools.toFile('lastParams_PMBR.pickle', param_settings)
+            last_params_path.write_text(json.dumps(param_settings))
             params = {'ID': param_settings[0],
                       'Session': param_settings[1],
                       'Run': param_settings[2],
@@ -137,6 +202,7 @@ def TI_countdown(window, t):
 
     The function draws a static circle and a number representing the countdown (in seconds).
     The countdown updates every second and is shown at the specified screen position. 
+    The window is only flipped on updates, the function sleeps in between.
     If the 'escape' key is pressed during the countdown, the function exits early.
 
     Args:
@@ -151,23 +217,87 @@ def TI_countdown(window, t):
     circle = visual.Circle(window, radius=0.1, pos=(0,0.2), fillColor=None, lineColor='black', lineWidth=4)
 
     circle.setAutoDraw(True); clk_text.setAutoDraw(True)
-    circle.draw(); clk_text.draw()
     window.flip()
-    timer = core.CountdownTimer(t)
-    while timer.getTime() > 0:
-        if t-timer.getTime() > 1:
+    clock = psyquartz.MonotonicClock()
+    duration = t
+    next_tick = 1 # elapsed time of the next countdown update
+    elapsed = clock.getTime()
+    while elapsed < duration:
+        if elapsed < next_tick:
+            # sleep until the next update, waking up every 50 ms to check for a user stop
+            psyquartz.sleep(min(next_tick - elapsed, 0.05))
+            pump_events(window)
+            if escape_pressed():
+                circle.setAutoDraw(False); clk_text.setAutoDraw(False)
+                return -1
+        else:
+            next_tick += 1
             t=t-1
             clk_text.setText(str(t))
             window.flip()
-            key = event.getKeys()
-            if key and key[0] in ['escape','esc']:
-                circle.setAutoDraw(False); clk_text.setAutoDraw(False)
-                return -1
+        elapsed = clock.getTime()
     circle.setAutoDraw(False); clk_text.setAutoDraw(False)
 
 
 
-def wait_b_pressed(joy, message=None, duration=button_duration, window=None):
+def pump_events(window):
+    """
+    Dispatches the pending joystick and window events without flipping the window.
+
+    Joystick values are only updated by the event dispatchers PsychoPy registers on the window
+    (`window._eventDispatchers`, one per joystick), which `win.flip()` normally runs once per frame,
+    and keys by the window's own event dispatch. Calling this function instead allows polling the
+    joysticks faster than the refresh rate. Each joystick dispatcher steps the pyglet event loop,
+    waiting up to 1 ms for new events, so a call lasts up to ~2 ms with the two joysticks and
+    no extra sleep is needed between two polls.
+
+    Args:
+        window (psychopy.visual.Window): The PsychoPy window owning the event loop.
+    """
+    for dispatcher in window._eventDispatchers: # same as PsychoPy's pyglet backend on flip
+        dispatcher.dispatch_events()
+    window.winHandle.dispatch_events()
+
+
+
+def wait_b_pressed_visual(message=None, window=None, n_frames=1):
+    """
+    Draws the message and flips the window for `n_frames` frames, before `wait_b_pressed` polls the button.
+
+    Args:
+        message (visual.TextStim, optional): A message to be displayed while waiting.
+        window (visual.Window): The PsychoPy window where the message is displayed.
+        n_frames (int): Number of frames to flip.
+    """
+    for frame in range(n_frames):
+        if message: message.draw()
+        window.flip()
+
+
+
+def wait_frames(n_frames, window, message=None):
+    """
+    Displays the message for `n_frames` frames, draining the keyboard events at each frame.
+    Unlike `core.wait`, the wait can be interrupted with the Escape key.
+
+    Args:
+        n_frames (int): Number of frames to wait.
+        window (visual.Window): The PsychoPy window where the message is displayed.
+        message (visual.TextStim, optional): A message to be displayed while waiting, redrawn at each frame.
+
+    Returns:
+        bool: True if the Escape key was pressed, False otherwise.
+    """
+    for frame in range(n_frames):
+        if message: message.draw()
+        window.flip()
+        if event.getKeys(keyList=['escape','esc']):
+            return True
+    return False
+
+
+
+def wait_b_pressed(joy, message=None, duration=button_duration, window=None, n_frames=1):
     """
     Waits for the participant to press joystick trigger button or until a timeout occurs.
 
@@ -176,11 +306,15 @@ def wait_b_pressed(joy, message=None, duration=button_duration, window=None):
     If the escape key is pressed, it returns -1 to indicate early termination.
     If no button is pressed within the allotted time, the full duration is returned.
 
+    The message is drawn once at entry (see `wait_b_pressed_visual`), the button is then polled without
+    flipping the window (every ~2 ms, see `pump_events`), so the RT resolution is not bound to the refresh rate.
+
     Args:
         joy (joystick.Joystick): The joystick object to monitor.
         message (visual.TextStim, optional): A message to be displayed while waiting.
         duration (float): Maximum waiting time (in seconds).
         window (visual.Window): The PsychoPy window where the message is displayed.
+        n_frames (int): Number of frames the message is flipped for before polling.
 
     Returns:
         float: Reaction time in seconds if button is pressed in time.
@@ -188,24 +322,91 @@ def wait_b_pressed(joy, message=None, duration=button_duration, window=None):
                Returns the full duration if no input is detected.
     """
 
-    timer = core.CountdownTimer(duration); RT=duration
-    
+    timer = FastCountdown(duration); RT=duration
+    wait_b_pressed_visual(message, window, n_frames)
+
     while timer.getTime()>0:
-        if message: message.draw()
-        window.flip()
+        pump_events(window)
         joy_button_pressed = joy.getButton(0)
         if joy_button_pressed:
             RT = duration - timer.getTime()
             return RT
         # Check for user stop
-        key = event.getKeys()
-        if key and key[0] in ['escape','esc']:
+        if escape_pressed():
             return -1
     return RT
 
 
 
-def wait_joystick_pushed(joy_r=None,joy_l=None, rect_right_green=None, rect_left_green=None, duration=joystick_duration, correct_rect=None, rect_left_red=None, rect_right_red=None, joystick_right=None, joystick_left=None, rect_right_black=None, rect_left_black=None):
+def make_buffers(max_samples):
+    """
+    Allocates the joystick position and time buffers of `wait_joystick_pushed`, one sample per frame.
+
+    Returns:
+        tuple: The (right_buf, left_buf, t_buf) buffers, of shapes (max_samples, 2), (max_samples, 2) and (max_samples,).
+    """
+    return (np.empty((max_samples,2),np.float32),
+            np.empty((max_samples,2),np.float32),
+            np.empty(max_samples))
+
+
+
+def extend_buffers(right_buf, left_buf, t_buf):
+    """
+    Doubles the size of the joystick position and time buffers of `wait_joystick_pushed`, keeping their content.
+    Only used if the screen refreshes faster than the refresh rate the buffers were sized for.
+
+    Returns:
+        tuple: The extended (right_buf, left_buf, t_buf) buffers.
+    """
+    return (np.concatenate((right_buf, np.empty_like(right_buf))),
+            np.concatenate((left_buf, np.empty_like(left_buf))),
+            np.concatenate((t_buf, np.empty_like(t_buf))))
+
+
+
+@njit(cache=True)
+def scan_axes(right_y, left_y, last_right, last_left, start_threshold):
+    """
+    Finds the first sample where each joystick started to move, from the y-axis positions recorded by `wait_joystick_pushed`.
+
+    A movement starts when the y-axis changes by more than `start_threshold` between two consecutive samples.
+    Compiled with Numba, the compiled function is cached on disk.
+
+    Args:
+        right_y (np.ndarray): Right joystick y-axis positions.
+        left_y (np.ndarray): Left joystick y-axis positions.
+        last_right (float): Right joystick y-axis position before the first sample.
+        last_left (float): Left joystick y-axis position before the first sample.
+        start_threshold (float): Minimal y-axis change marking the start of a movement.
+
+    Returns:
+        tuple: Indices (start_right, start_left) of the movement start samples, -1 if the joystick didn't move.
+    """
+    start_right = -1
+    start_left = -1
+    for i in range(right_y.shape[0]):
+        if start_right < 0 and abs(right_y[i] - last_right) > start_threshold:
+            start_right = i
+        if start_left < 0 and abs(left_y[i] - last_left) > start_threshold:
+            start_left = i
+        last_right = right_y[i]
+        last_left = left_y[i]
+    return start_right, start_left
+
+
+
+def warm_up_scan_axes():
+    """
+    Compiles `scan_axes` (or loads it from the cache) so the first joystick trial doesn't wait for it.
+    Called with the argument types of `wait_joystick_pushed`: float32 buffer views and float positions.
+    """
+    right_buf, left_buf, t_buf = make_buffers(2)
+    scan_axes(right_buf[:,y_axis], left_buf[:,y_axis], 0.0, 0.0, movement_start_threshold)
+
+
+
+def wait_joystick_pushed(joy_r=None,joy_l=None, rect_right_green=None, rect_left_green=None, duration=joystick_duration, correct_rect=None, rect_left_red=None, rect_right_red=None, joystick_right=None, joystick_left=None, rect_right_black=None, rect_left_black=None, background=None, buffers=None):
     """
     Waits for a joystick push (center-out movement) from either the left or right joystick
     within a specified time window and records various data including reaction times and monitored joystick positions.
@@ -235,6 +436,10 @@ def wait_joystick_pushed(joy_r=None,joy_l=None, rect_right_green=None, rect_left
         joystick_left (joystick.Joystick): Joystick object for the left hand.
         rect_right_black (visual.Rect): Black rectangle cue indicating right-side is the target.
         rect_left_black (visual.Rect): Black rectangle cue indicating left-side is the target.
+        background (visual.BufferImageStim, optional): Pre-composed cue rectangle and joysticks (see `compose_cue_background`),
+            drawn in a single call instead of the individual stimuli. The feedback rectangles are drawn over its cue rectangle.
+        buffers (tuple): Preallocated (right_buf, left_buf, t_buf) joystick position and time buffers (see `make_buffers`),
+            reused from one call to the next instead of allocating new ones. The returned positions and time are copies.
 
     Returns:
         dict or int:
@@ -243,158 +448,220 @@ def wait_joystick_pushed(joy_r=None,joy_l=None, rect_right_green=None, rect_left
                 - 'RT_end_left': Reaction time for when left joystick joystick reaches threshold position (90% of y-axis) (if applicable)
                 - 'RT_start_right': Time when right joystick started to move
                 - 'RT_start_left': Time when left joystick started to move
-                - 'right_positions': List of [x, y] positions for right joystick over time
-                - 'left_positions': List of [x, y] positions for left joystick over time
-                - 'time': List of timestamps corresponding to each joystick position sample
+                  (reaction times are NaN if not applicable)
+                - 'right_positions': Array (n_samples, 2) of [x, y] positions for right joystick over time
+                - 'left_positions': Array (n_samples, 2) of [x, y] positions for left joystick over time
+                - 'time': Array (n_samples,) of timestamps corresponding to each joystick position sample
             - Returns -1 if the user presses the Escape key to abort.
     """
 
     #initiate empty variables
-    RT = None
-    output = {'RT_end_right': RT, 'RT_end_left': RT, 'RT_start_right': RT, 'RT_start_left': RT,'right_positions':[], 'left_positions':[], 'time':[]}
-    right_positions = []
-    left_positions = []
-    time = []
-    timer = core.CountdownTimer(duration)
-
-    flag_RT_start = False
-
-    #get initial joysticks positions
-    last_value_right=joystick_right.getY()
-    last_value_left=joystick_left.getY()
+    RT = math.nan # missing reaction times are NaN, saved as 'NA' in the trial log
+    output = {'RT_end_right': RT, 'RT_end_left': RT, 'RT_start_right': RT, 'RT_start_left': RT,
+              'right_positions':np.empty((0,2),np.float32), 'left_positions':np.empty((0,2),np.float32), 'time':np.empty(0)}
+
+    # joysticks positions and time buffers, filled up to n_samples
+    right_buf, left_buf, t_buf = buffers # extended buffers are local to this call
+    n_samples = 0
+    timer = FastCountdown(duration)
+
+    pushed = None # side of the first joystick pushed over the threshold, feedback is shown from then until the end of the timer
+
+    # (correct, incorrect) feedback rectangles, drawn around the correct side
+    feedback_rects = {'right': (rect_right_green, rect_right_red), 'left': (rect_left_green, rect_left_red)}
+
+    #get initial joysticks positions, as floats like in the scan_axes warm-up (pyglet axes are the int 0 until the first axis event)
+    last_value_right=float(joystick_right.getAllAxes()[y_axis])
+    last_value_left=float(joystick_left.getAllAxes()[y_axis])
  
 
     while timer.getTime()>0: #monitors joysticks positions while the timer doesn't hit the duration limit
-        if correct_rect == 'right':
-            rect_right_black.draw()
-        if correct_rect == 'left':
-            rect_left_black.draw()
-        if joy_l: joy_l.draw()
-        if joy_r: joy_r.draw()
+        if background:
+            background.draw()
+        else:
+            if not pushed:
+                if correct_rect == 'right':
+                    rect_right_black.draw()
+                if correct_rect == 'left':
+                    rect_left_black.draw()
+            if joy_l: joy_l.draw()
+            if joy_r: joy_r.draw()
 
         win.flip() #flipping the window is necessary to update both the screen with new elements and the joysticks position 
-        joy_right_y_axis = joystick_right.getY()
-        joy_left_y_axis = joystick_left.getY()
-        joy_right_x_axis = joystick_right.getX() #x-axis positions are also monitored for velocity analysis
-        joy_left_x_axis = joystick_left.getX()
+        axes_right = joystick_right.getAllAxes() #one call per joystick, x-axis positions are also monitored for velocity analysis
+        axes_left = joystick_left.getAllAxes()
+        joy_right_x_axis, joy_right_y_axis = axes_right[x_axis], axes_right[y_axis]
+        joy_left_x_axis, joy_left_y_axis = axes_left[x_axis], axes_left[y_axis]
         #print(f'Joy right: {joy_right_y_axis}, Joy left: {joy_left_y_axis}') #for debugging
 
-        # Store RT start if the correct joystick is moved
-        if np.abs(joy_right_y_axis - last_value_right) > 0.005 and not flag_RT_start and correct_rect == 'right' :
-            output['RT_start_right'] = duration - timer.getTime()
-            flag_RT_start = True
-        
-        if np.abs(joy_left_y_axis - last_value_left) > 0.005 and not flag_RT_start and correct_rect == 'left' :
-            output['RT_start_left'] = duration - timer.getTime()
-            flag_RT_start = True
-
-        last_value_right = joy_right_y_axis
-        last_value_left = joy_left_y_axis
-
         # stores joysticks positions and time for velocity analysis
-        right_positions.append([joy_right_x_axis, joy_right_y_axis])
-        left_positions.append([joy_left_x_axis, joy_left_y_axis])
-        time.append(timer.getTime())
-        
-
-        # right joystick pushed
-        if joy_right_y_axis<-0.9: 
-
-            if correct_rect == 'right':
-                rect_right_green.autoDraw = True
+        if n_samples == len(t_buf):
+            right_buf, left_buf, t_buf = extend_buffers(right_buf, left_buf, t_buf)
+        right_buf[n_samples,0] = joy_right_x_axis; right_buf[n_samples,1] = joy_right_y_axis
+        left_buf[n_samples,0] = joy_left_x_axis; left_buf[n_samples,1] = joy_left_y_axis
+        t_buf[n_samples] = timer.getTime()
+        n_samples += 1
+
+        if pushed:
+            continue # only store joystick positions until the end of the timer
+
+        # joystick pushed, the right one is checked first if both crossed the threshold
+        crossed_right = joy_right_y_axis < movement_end_threshold
+        if crossed_right or joy_left_y_axis < movement_end_threshold:
+            pushed = 'right' if crossed_right else 'left'
+            n_decision = n_samples # movement starts are only searched up to the sample of the push
+            correct = pushed == correct_rect
+            feedback_rects[correct_rect][not correct].autoDraw = True
+            if correct:
                 RT = duration - timer.getTime()
-                #send_trigger(7) #correct right answer
+            #send_trigger(feedback_triggers[pushed][not correct]) #5/7 correct left/right answer, 6/8 incorrect left/right answer
 
-            elif correct_rect == 'left':
-                rect_left_red.autoDraw = True
-                #send_trigger(8) #incorrect right answer
-            joy_l.draw()
-            joy_r.draw()
-            win.flip()
-
-            
-            # store joystick positions until the end of the timer and update joysticks values
-            while timer.getTime()>0:
-                joy_right_y_axis = joystick_right.getY()
-                joy_left_y_axis = joystick_left.getY()
-                joy_right_x_axis = joystick_right.getX()
-                joy_left_x_axis = joystick_left.getX()
-                right_positions.append([joy_right_x_axis, joy_right_y_axis])
-                left_positions.append([joy_left_x_axis, joy_left_y_axis])
-                time.append(timer.getTime())
-                win.flip()
-            
-            output['RT_end_right'] = RT
-            output['right_positions'] = right_positions
-            output['left_positions'] = left_positions
-            output['time'] = time
-
-            win.flip()
-            rect_right_red.autoDraw = False
-            rect_left_red.autoDraw = False
-            rect_right_green.autoDraw= False
-            rect_left_green.autoDraw = False
-            return output
-        
-        #left joystick pushed
-        elif joy_left_y_axis<-0.9:
-
-            if correct_rect == 'right':
-                rect_right_red.autoDraw = True
-                #send_trigger(6) #incorrect left answer
-
-            elif correct_rect == 'left':
-                rect_left_green.autoDraw = True
-                RT = duration - timer.getTime()
-                #send_trigger(5) #correct left answer
-            joy_l.draw()
-            joy_r.draw()
-            win.flip()
-            while timer.getTime()>0:
-                joy_right_y_axis = joystick_right.getY()
-                joy_left_y_axis = joystick_left.getY()
-                joy_right_x_axis = joystick_right.getX()
-                joy_left_x_axis = joystick_left.getX()
-                right_positions.append([joy_right_x_axis, joy_right_y_axis])
-                left_positions.append([joy_left_x_axis, joy_left_y_axis])
-                time.append(timer.getTime())
-                win.flip()
-
-            output['RT_end_left'] = RT
-            output['right_positions'] = right_positions
-            output['left_positions'] = left_positions
-            output['time'] = time
-
-            win.flip()
+        # Check for user stop
+        if escape_pressed():
             rect_right_red.autoDraw = False
             rect_left_red.autoDraw = False
             rect_right_green.autoDraw= False
             rect_left_green.autoDraw = False
-            return output
-        # Check for user stop
-        key = event.getKeys()
-        if key and key[0] in ['escape','esc']:
             return -1
+
+    # Store RT start if the correct joystick is moved
+    n_scan = n_decision if pushed else n_samples
+    start_right, start_left = scan_axes(right_buf[:n_scan,y_axis], left_buf[:n_scan,y_axis], last_value_right, last_value_left, movement_start_threshold)
+    start = start_right if correct_rect == 'right' else start_left
+    if correct_rect in feedback_rects and start >= 0:
+        output['RT_start_'+correct_rect] = duration - t_buf[start]
+
+    if pushed:
+        output['RT_end_'+pushed] = RT
+        output['right_positions'] = right_buf[:n_samples].copy() # the buffers are overwritten by the next call
+        output['left_positions'] = left_buf[:n_samples].copy()
+        output['time'] = t_buf[:n_samples].copy()
+
+        # feedback stays on screen until the caller's next flip
+        rect_right_red.autoDraw = False
+        rect_left_red.autoDraw = False
+        rect_right_green.autoDraw= False
+        rect_left_green.autoDraw = False
     return output
 
 def buffer_joystick(joy1, joy2, duration=2):
     """
     Buffers joystick values for a given duration. Useful to avoid the code not updating values between trials.
+    The joystick and window events are dispatched without flipping (see `pump_events`), so the joystick event queue is fully drained.
     Returns a list of joystick positions.
     """
-    timer = core.CountdownTimer(duration)
+    timer = FastCountdown(duration)
     positions = []
     
     while timer.getTime() > 0:
+        pump_events(win)
         axes1 = joy1.getAllAxes()
         axes2 = joy2.getAllAxes()
         positions.append((axes1, axes2))
-        win.flip()
-        core.wait(0.001)  # Small delay to avoid overwhelming the buffer
     
     return positions
 
 
+@functools.lru_cache(maxsize=None)
+def get_static_stims(window):
+    """
+    Creates the static text and rectangle stimuli of the task, once per window.
+
+    The stimuli are cached, so later calls with the same window reuse them instead of
+    rebuilding the text glyphs and shapes.
+
+    Args:
+        window (psychopy.visual.Window): The PsychoPy window to draw on.
+
+    Returns:
+        types.SimpleNamespace: The stimuli, as attributes named after their role (e.g. `rect_right_green`).
+    """
+    return SimpleNamespace(
+        # Instructions
+        instructions2_0=visual.TextStim(window, text="Joystick Task",pos=(0,0.4),color=(-1,-1,-1),height=0.05,bold=True),
+        instructions2_1=visual.TextStim(window, text="Please press the trigger button under your right index finger when you see the message:",pos=(0,0.2),color=(-1,-1,-1),height=0.04),
+        instructions2_2=visual.TextStim(window, text="PRESS",pos=(0,0.03),color=(-1,-1,-1),height=0.06,bold=True),
+        instructions2_3=visual.TextStim(window, text="On the screen, if the image of a joystick increases in size, push the corresponding joystick forward",pos=(0,-0.2),color=(-1,-1,-1),height=0.04),
+        instructions2_4=visual.TextStim(window, text="Try to be as quick and accurate as possible.",pos=(0,-0.3),color=(-1,-1,-1),height=0.04),
+
+        # ISI cross
+        isi_cross=visual.TextStim(window, text="+",pos=(0,0.05),color=(-1,-1,-1),height=0.2,bold=True),
+
+        # Press message
+        press_message=visual.TextStim(window, text="PRESS",pos=(0,0.05),color=(-1,-1,-1),height=0.05,bold=True),
+
+        # Correct rectangles
+        rect_right_green=visual.Rect(window, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='green', lineWidth=4, fillColor = None),
+        rect_left_green=visual.Rect(window, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='green', lineWidth=4, fillColor = None),
+        rect_right_red=visual.Rect(window, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='red', lineWidth=4,  fillColor = None),
+        rect_left_red=visual.Rect(window, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='red', lineWidth=4, fillColor = None),
+        rect_right_black=visual.Rect(window, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='black', lineWidth=4, fillColor = None),
+        rect_left_black=visual.Rect(window, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='black', lineWidth=4, fillColor = None),
+
+        # Press test message definition
+        press_test_message=visual.TextStim(window, text="We will now train on the first part of the task.", pos=(0, 0.4), color=(-1, -1, -1), height=0.05, bold=False),
+        press_test_message2=visual.TextStim(window, text="Please press the trigger button under your right index when you see the message:", pos=(0, 0.2), color=(-1, -1, -1), height=0.04),
+        press_test_message3=visual.TextStim(window, text="PRESS", pos=(0, 0.03), color=(-1, -1, -1), height=0.06, bold=True),
+        press_test_message4=visual.TextStim(window, text="Try to be as fast and accurate as possible.", pos=(0, -0.2), color=(-1, -1, -1), height=0.04),
+
+        # Joystick test message definition
+        joy_text=visual.TextStim(window, text="Now, we will train on the second part of the task", pos=(0, 0.4), color=(-1, -1, -1), height=0.04),
+        joy_text2=visual.TextStim(window, text="Please push the joystick that increases in size forward", pos=(0, 0.2), color=(-1, -1, -1), height=0.04),
+        joy_text3=visual.TextStim(window, text="If you push the correct joystick, a green rectangle will appear around it and a red rectangle if you push the wrong one.", pos=(0, 0.03), color=(-1, -1, -1), height=0.04),
+        joy_text4=visual.TextStim(window, text="Try to be as fast and accurate as possible.", pos=(0, -0.2), color=(-1, -1, -1), height=0.04),
+
+        # Ready message
+        ready_message=visual.TextStim(window, text="We will now start the task, any questions? ", pos=(0, 0.03), color=(-1, -1, -1), height=0.03, bold=True),
+
+        # End of block and end of task messages, the reaction time text is set at the end of each block
+        RT_message=visual.TextStim(window, text="", pos=(0,0), color=(-1,-1,-1), height=0.05, bold=True),
+        break_message=visual.TextStim(window, text="BREAK", pos=(0, 0), color=(-1, -1, -1), height=0.05, bold=True),
+        end_message=visual.TextStim(window, text="End of task. Thank you for your participation!", pos=(0, 0), color=(-1, -1, -1), height=0.05, bold=True),
+    )
+
+
+
+def compose_cue_background(window, joy_cued, joy_other, rect_cue):
+    """
+    Renders the cue of a joystick trial (cue rectangle, enlarged cued joystick and other joystick) into a single stimulus.
+
+    Args:
+        window (psychopy.visual.Window): The PsychoPy window to draw on.
+        joy_cued (visual.ImageStim): Enlarged image of the joystick to push.
+        joy_other (visual.ImageStim): Image of the other joystick.
+        rect_cue (visual.Rect): Black rectangle around the joystick to push.
+
+    Returns:
+        visual.BufferImageStim: The pre-composed cue, to be drawn in place of the individual stimuli.
+    """
+    background = visual.BufferImageStim(window, stim=[rect_cue, joy_cued, joy_other])
+    window.clearBuffer()
+    return background
+
+
+
+def save_rows(rows, path, header):
+    """
+    Appends trial rows to the runs file.
+
+    Trials without a button response (NaN `RT_press`) are written as 'NA' from `RT_press` on,
+    other missing values (e.g. no joystick movement) as empty cells.
+
+    Args:
+        rows (np.ndarray): Structured array of trial rows, with the `log_dtype` columns.
+        path (Path): Path of the runs file.
+        header (bool): Whether to write the column names first (new runs file).
+    """
+    df = pd.DataFrame(rows)
+    no_response = df['RT_press'].isna()
+    if no_response.any():
+        na_columns = list(log_dtype.names[log_dtype.names.index('RT_press'):])
+        df[na_columns] = df[na_columns].astype(object)
+        df.loc[no_response, na_columns] = 'NA'
+    df.to_csv(path, mode='a', header=header, index=False, na_rep='')
+
+
+
 def mouse_clear(mouse):
     mouse.setPos((-10,-10)) # Out of screen
 
@@ -449,61 +716,38 @@ def show_task(params, nTrials=100):
 
     """
     
-    global run_path, win, conditions_df
+    global run_path, win, conditions_df, rng, refresh_rate
     
-    instructions2_0=visual.TextStim(win,text="Joystick Task",pos=(0,0.4),color=(-1,-1,-1),height=0.05,bold=True)
-    instructions2_1=visual.TextStim(win,text="Please press the trigger button under your right index finger when you see the message:",pos=(0,0.2),color=(-1,-1,-1),height=0.04)
-    instructions2_2=visual.TextStim(win,text="PRESS",pos=(0,0.03),color=(-1,-1,-1),height=0.06,bold=True)
-    instructions2_3=visual.TextStim(win,text="On the screen, if the image of a joystick increases in size, push the corresponding joystick forward",pos=(0,-0.2),color=(-1,-1,-1),height=0.04)
-    instructions2_4=visual.TextStim(win,text="Try to be as quick and accurate as possible.",pos=(0,-0.3),color=(-1,-1,-1),height=0.04)
+    stims = get_static_stims(win) #static text and rectangle stimuli, created once per window
     mouse = event.Mouse(visible=False)
 
     #init joysticks
     joy1 = joystick.Joystick(0)
     joy2 = joystick.Joystick(1)
 
-    # ISI cross
-    isi_cross = visual.TextStim(win,text="+",pos=(0,0.05),color=(-1,-1,-1),height=0.2,bold=True)
+    # size of the joystick position buffers for the measured refresh rate (one sample per frame)
+    max_samples = int(math.ceil(refresh_rate * joystick_duration)) + 64
+    trajectory_buffers = make_buffers(max_samples) # allocated once, reused by every trial (practice included)
 
     #Joytick images
     joy_r_image_path = os.path.join("Images", "t16_right.png")
     joy_r_image = visual.ImageStim(win, image=joy_r_image_path, pos=(0.55,0.07))
     joy_l_image_path = os.path.join("Images", "t16_left.png")
     joy_l_image = visual.ImageStim(win, image=joy_l_image_path, pos=(-0.55,0.07))
+    #Enlarged images of the joystick to push, swapped with the normal ones instead of resizing them
+    joy_r_image_big = visual.ImageStim(win, image=joy_r_image_path, pos=(0.55,0.07), size=joy_r_image.size + (x_size_increase, y_size_increase))
+    joy_l_image_big = visual.ImageStim(win, image=joy_l_image_path, pos=(-0.55,0.07), size=joy_l_image.size + (x_size_increase, y_size_increase))
 
-    #Press message
-    press_message=visual.TextStim(win,text="PRESS",pos=(0,0.05),color=(-1,-1,-1),height=0.05,bold=True)
-
-    #Correct rectangles
-    rect_right_green = visual.Rect(win, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='green', lineWidth=4, fillColor = None)
-    rect_left_green = visual.Rect(win, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='green', lineWidth=4, fillColor = None)
-    rect_right_red = visual.Rect(win, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='red', lineWidth=4,  fillColor = None)
-    rect_left_red = visual.Rect(win, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='red', lineWidth=4, fillColor = None)
-    rect_right_black = visual.Rect(win, width=0.65, height=0.75, pos=(0.55,0.07), lineColor='black', lineWidth=4, fillColor = None)
-    rect_left_black = visual.Rect(win, width=0.65, height=0.75, pos=(-0.55,0.07), lineColor='black', lineWidth=4, fillColor = None)  
-
-    # Press test message definition
-    press_test_message = visual.TextStim(win, text="We will now train on the first part of the task.", pos=(0, 0.4), color=(-1, -1, -1), height=0.05, bold=False)
-    press_test_message2 = visual.TextStim(win, text="Please press the trigger button under your right index when you see the message:", pos=(0, 0.2), color=(-1, -1, -1), height=0.04)
-    press_test_message3 = visual.TextStim(win, text="PRESS", pos=(0, 0.03), color=(-1, -1, -1), height=0.06, bold=True)
-    press_test_message4 = visual.TextStim(win, text="Try to be as fast and accurate as possible.", pos=(0, -0.2), color=(-1, -1, -1), height=0.04)
-
-    
-    # Joystick test message definition
-    joy_text = visual.TextStim(win, text="Now, we will train on the second part of the task", pos=(0, 0.4), color=(-1, -1, -1), height=0.04)
-    joy_text2 = visual.TextStim(win, text="Please push the joystick that increases in size forward", pos=(0, 0.2), color=(-1, -1, -1), height=0.04)
-    joy_text3 = visual.TextStim(win, text="If you push the correct joystick, a green rectangle will appear around it and a red rectangle if you push the wrong one.", pos=(0, 0.03), color=(-1, -1, -1), height=0.04)
-    joy_text4 = visual.TextStim(win, text="Try to be as fast and accurate as possible.", pos=(0, -0.2), color=(-1, -1, -1), height=0.04)
-
-    # Ready message
-    ready_message = visual.TextStim(win, text="We will now start the task, any questions? ", pos=(0, 0.03), color=(-1, -1, -1), height=0.03, bold=True)
+    #Cues of the joystick trials, pre-composed to draw them in one call per frame
+    cue_backgrounds = {'right': compose_cue_background(win, joy_r_image_big, joy_l_image, stims.rect_right_black),
+                       'left': compose_cue_background(win, joy_l_image_big, joy_r_image, stims.rect_left_black)}
     
     # Instructions
-    instructions2_0.draw()
-    instructions2_1.draw()
-    instructions2_2.draw()
-    instructions2_3.draw()
-    instructions2_4.draw()
+    stims.instructions2_0.draw()
+    stims.instructions2_1.draw()
+    stims.instructions2_2.draw()
+    stims.instructions2_3.draw()
+    stims.instructions2_4.draw()
     win.flip()   
 
     # Wait for keyboard input
@@ -518,10 +762,10 @@ def show_task(params, nTrials=100):
     if params['Set'] == 'P': # Practice run
 
         #press test message
-        press_test_message.draw()
-        press_test_message2.draw()
-        press_test_message3.draw()
-        press_test_message4.draw()
+        stims.press_test_message.draw()
+        stims.press_test_message2.draw()
+        stims.press_test_message3.draw()
+        stims.press_test_message4.draw()
         win.flip()
         key = event.waitKeys(keyList=['space','5','esc','escape']) 
         if key and key[0] in ['escape','esc']:
@@ -533,21 +777,21 @@ def show_task(params, nTrials=100):
 
             joy_l_image.autoDraw = True
             joy_r_image.autoDraw = True
-            #isi_cross.draw()
+            #stims.isi_cross.draw()
             win.flip() # Clear the screen for the ISI
             core.wait(2)
             mouse_clear(mouse)
-            key = wait_b_pressed(joy1, press_message, 0.6, win)
+            key = wait_b_pressed(joy1, stims.press_message, 0.6, win)
             
         
         joy_l_image.autoDraw = False
         joy_r_image.autoDraw = False
 
         # Joystick test message
-        joy_text.draw()
-        joy_text2.draw()
-        joy_text3.draw()
-        joy_text4.draw()
+        stims.joy_text.draw()
+        stims.joy_text2.draw()
+        stims.joy_text3.draw()
+        stims.joy_text4.draw()
         win.flip()
         key = event.waitKeys(keyList=['space','5','esc','escape'])
         if key and key[0] in ['escape','esc']:
@@ -566,31 +810,27 @@ def show_task(params, nTrials=100):
             core.wait(2)
 
             if i % 2 == 0: 
-                joy_r_image.size += (x_size_increase, y_size_increase)
-                output = wait_joystick_pushed(joy_r_image,joy_l_image,rect_right_green,rect_left_green, duration=1, correct_rect='right', rect_left_red=rect_left_red, rect_right_red=rect_right_red, joystick_right=joy1, joystick_left=joy2, rect_left_black=rect_left_black, rect_right_black=rect_right_black)
-                joy_r_image.size -= (x_size_increase, y_size_increase)
-                win.flip() 
-
-                joy_l_image.draw()
-                joy_r_image.draw()
-                win.flip()  
+                joy_r_image.autoDraw = False
+                joy_r_image_big.autoDraw = True
+                output = wait_joystick_pushed(joy_r_image_big,joy_l_image,stims.rect_right_green,stims.rect_left_green, duration=1, correct_rect='right', rect_left_red=stims.rect_left_red, rect_right_red=stims.rect_right_red, joystick_right=joy1, joystick_left=joy2, rect_left_black=stims.rect_left_black, rect_right_black=stims.rect_right_black, buffers=trajectory_buffers)
+                joy_r_image_big.autoDraw = False
+                joy_r_image.autoDraw = True
+                win.flip() # joysticks back to normal size, drawn by autoDraw
 
             elif i % 2 == 1:
-                joy_l_image.size += (x_size_increase, y_size_increase)
-                output = wait_joystick_pushed(joy_r_image,joy_l_image,rect_right_green,rect_left_green, duration=1, correct_rect='left', rect_left_red=rect_left_red, rect_right_red=rect_right_red, joystick_right=joy1, joystick_left=joy2, rect_left_black=rect_left_black, rect_right_black=rect_right_black)
-                joy_l_image.size -= (x_size_increase, y_size_increase)
-                win.flip() 
-
-                joy_l_image.draw()
-                joy_r_image.draw()
-                win.flip()
+                joy_l_image.autoDraw = False
+                joy_l_image_big.autoDraw = True
+                output = wait_joystick_pushed(joy_r_image,joy_l_image_big,stims.rect_right_green,stims.rect_left_green, duration=1, correct_rect='left', rect_left_red=stims.rect_left_red, rect_right_red=stims.rect_right_red, joystick_right=joy1, joystick_left=joy2, rect_left_black=stims.rect_left_black, rect_right_black=stims.rect_right_black, buffers=trajectory_buffers)
+                joy_l_image_big.autoDraw = False
+                joy_l_image.autoDraw = True
+                win.flip() # joysticks back to normal size, drawn by autoDraw
 
 
         joy_l_image.autoDraw = False
         joy_r_image.autoDraw = False
 
         # Ready message
-        ready_message.draw()
+        stims.ready_message.draw()
         win.flip()
         key = event.waitKeys(keyList=['space','5','esc','escape'])
         if key and key[0] in ['escape','esc']:
@@ -602,8 +842,7 @@ def show_task(params, nTrials=100):
     mouse_clear(mouse)
 
     
-    log = dict.fromkeys(('ID','Session','Run','Trial'))
-    local_timer = core.MonotonicClock()
+    local_timer = psyquartz.MonotonicClock()
 
     
     nb_blocks = params['NbBlocks']
@@ -620,21 +859,27 @@ def show_task(params, nTrials=100):
     nb_movements = int(nb_trials*percentage_joystick) #Define the number of total joystick center-out movements
     Nb_right = int(nb_movements/2) # Defines the number of right joystick movements (half the total)
 
-    idcs=np.array(random.sample(range(0,nb_trials), nb_movements)) #Defines the trials where the joystick will be moved
-    idx_right=random.sample(range(nb_movements),Nb_right) # Defines the indices of the trials where the right joystick will be moved
-    idx_left=np.delete(idcs,idx_right) # Defines the indices of the trials where the left joystick will be moved
-
-    mask=np.zeros(len(idcs),bool)
-    mask[idx_right]=True
-    idx_right=idcs[mask] # trials where the right joystick will be moved (this method was chosen to avoid selecting the same index for both sides)
+    idcs=rng.choice(nb_trials, nb_movements, replace=False) #Defines the trials where the joystick will be moved
+    perm=rng.permutation(nb_movements) # Shuffles these trials once, then splits them so no index is selected for both sides
+    idx_right=idcs[perm[:Nb_right]] # trials where the right joystick will be moved
+    idx_left=idcs[perm[Nb_right:]] # trials where the left joystick will be moved
 
-    right_positions = []
-    left_positions = []
+    right_positions = np.empty((0,2),np.float32)
+    left_positions = np.empty((0,2),np.float32)
     RT_end_right = 0
     RT_end_left = 0
     RT_start_right = 0
     RT_start_left = 0
 
+    # Ensure all blocks are the same duration by uniformally distributing the jitters, shuffled independently for each block
+    jitters_1_all = rng.permuted(np.tile(np.round(np.linspace(0.65, 0.85, nb_trials), 2), (nb_blocks, 1)), axis=1)
+    jitters_2_all = rng.permuted(np.tile(np.round(np.linspace(1, 2, nb_trials), 2), (nb_blocks, 1)), axis=1)
+
+    # Warm up the display pipeline and drain stale joystick events, so the first trial is not slower than the next ones
+    for frame in range(warmup_frames):
+        win.flip()
+    buffer_joystick(joy1, joy2, duration=0.25)
+
     #send_trigger(pin=2) #start stimulation
 
 
@@ -645,216 +890,189 @@ def show_task(params, nTrials=100):
 
 
     
+    # Trials are stored in a structured array, one row per trial, and saved at the end of each block (if not practice run)
+    save_trials = params['Set'] != 'P'
+    need_header = not run_path.exists() # See if run file already exist, only checked once per run
+
     for block in range(nb_blocks):
-        log['Block'] = block + 1
-        RTs = []
+        rows = np.empty(nb_trials, dtype=log_dtype)
+        rt_sum = 0.0 # sum and number of the RT values shown at the end of the block
+        rt_n = 0
         #load conditions from file
         conditions = conditions_df[conditions_df['block'] == block + 1]
         task_conditions = conditions['task_condition'].values
 
-        # Ensure all blocks are the same duration by uniformally distributing the jitters
-        jitters_1 = np.linspace(0.65, 0.85, nb_trials)
-        jitters1shuffled = np.random.permutation(jitters_1)
-        jitters_1 = [round(i, 2) for i in jitters1shuffled]
-        jitters_2 = np.linspace(1, 2, nb_trials)
-        jitters2shuffled = np.random.permutation(jitters_2)
-        jitters_2 = [round(i, 2) for i in jitters2shuffled]
+        jitters_1 = jitters_1_all[block]
+        jitters_2 = jitters_2_all[block]
         #send_trigger(9) #block start
 
-        for trial in range(nb_trials):
+        n_done = 0 # completed trials of the block
+        try:
+            for trial in range(nb_trials):
 
-            condition = task_conditions[trial]
+                condition = task_conditions[trial]
             
-            RT_press=0
-            RT_end_right = 0
-            RT_end_left = 0
-            RT_start_right = 0
-            RT_start_left = 0
-            time=0
-            joy_l_image.autoDraw = True
-            joy_r_image.autoDraw = True
-            win.flip()
+                RT_press=0
+                RT_end_right = 0
+                RT_end_left = 0
+                RT_start_right = 0
+                RT_start_left = 0
+                time=0
+                joy_l_image.autoDraw = True
+                joy_r_image.autoDraw = True
+                win.flip()
 
-            t1=local_timer.getTime()
-            log['TrialStart'] = t1
-            core.wait(1) # Wait for 1 second before the press message
+                t1=local_timer.getTime()
+                core.wait(1) # Wait for 1 second before the press message
 
-            press_message.draw()
-            win.flip() 
-            mouse_clear(mouse)
-            RT_press = wait_b_pressed(joy1, press_message, button_duration, win) # Press message, wait for trigger button press, self paced but lasts for max 0.6s
+                stims.press_message.draw()
+                win.flip() 
+                mouse_clear(mouse)
+                RT_press = wait_b_pressed(joy1, stims.press_message, button_duration, win) # Press message, wait for trigger button press, self paced but lasts for max 0.6s
 
-            #TI-EEG trigger
-            #send_trigger(pin=2)
+                #TI-EEG trigger
+                #send_trigger(pin=2)
 
 
-            # User hit escape
-            if RT_press == -1:
-                print('Escape hit - bailing')
-                return -1
+                # User hit escape
+                if RT_press == -1:
+                    print('Escape hit - bailing')
+                    return -1
         
-            if RT_press > 0.05: # We have a response
+                if RT_press > 0.05: # We have a response
 
-                win.flip() 
-                joy_l_image.draw()
-                joy_r_image.draw()
-                win.flip() 
+                    win.flip() # clears the press message, joysticks drawn by autoDraw
                 
 
-                if RT_press == 1:
-                    #send_trigger(pin=4) # No response
-                    print('hi')
-                else:
-                    #send_trigger(pin=2) # Response
-                    #send_trigger(pin=3)
-                    print('hello')
+                    if RT_press == 1:
+                        #send_trigger(pin=4) # No response
+                        print('hi')
+                    else:
+                        #send_trigger(pin=2) # Response
+                        #send_trigger(pin=3)
+                        print('hello')
                     
-                isi = jitters_1[trial] # Get the jitter for this trial 
-                core.wait(isi) # Wait for ~0.75 seconds before the joystick push
+                    isi = jitters_1[trial] # Get the jitter for this trial 
+                    core.wait(isi) # Wait for ~0.75 seconds before the joystick push
 
 
-                # trial where right joystick will be pushed
-                if condition == 2: 
+                    # trial where right joystick will be pushed
+                    if condition == 2: 
                     
-                    joy_r_image.size += (x_size_increase, y_size_increase) #enlarge the right joystick
-                    joy_r_image.draw()
-                    joy_l_image.draw()
-                    rect_right_black.draw()
-                    win.flip()
-                    output = wait_joystick_pushed(
-                        joy_r_image,joy_l_image,rect_right_green,rect_left_green,duration = joystick_duration, 
-                        correct_rect='right', rect_left_red=rect_left_red, rect_right_red=rect_right_red,
-                          joystick_right=joy1, joystick_left=joy2, rect_left_black=rect_left_black, rect_right_black=rect_right_black) # wait for joystick push, lasts 1 seconds
+                        joy_l_image.autoDraw = False # joysticks are drawn by the cue background
+                        joy_r_image.autoDraw = False
+                        cue_backgrounds['right'].draw() #enlarged right joystick
+                        win.flip()
+                        output = wait_joystick_pushed(
+                            joy_r_image,joy_l_image,stims.rect_right_green,stims.rect_left_green,duration = joystick_duration, 
+                            correct_rect='right', rect_left_red=stims.rect_left_red, rect_right_red=stims.rect_right_red,
+                              joystick_right=joy1, joystick_left=joy2, rect_left_black=stims.rect_left_black, rect_right_black=stims.rect_right_black,
+                              background=cue_backgrounds['right'], buffers=trajectory_buffers) # wait for joystick push, lasts 1 seconds
+                        joy_l_image.autoDraw = True
+                        joy_r_image.autoDraw = True
+                        if output == -1: # User hit escape
+                            print('Escape hit - bailing')
+                            return -1
                    
                     
-                    RT_end_right = output['RT_end_right']
-                    RT_end_left = output['RT_end_left']
-                    right_positions = output['right_positions']
-                    left_positions = output['left_positions']
-                    RT_start_right = output['RT_start_right']
-                    RT_start_left = output['RT_start_left']
-                    time = output['time']
+                        RT_end_right = output['RT_end_right']
+                        RT_end_left = output['RT_end_left']
+                        right_positions = output['right_positions']
+                        left_positions = output['left_positions']
+                        RT_start_right = output['RT_start_right']
+                        RT_start_left = output['RT_start_left']
+                        time = output['time']
                     
-                    joy_r_image.size -= (x_size_increase, y_size_increase)
-                    win.flip() # Clear the screen for the ISI
-                    joy_l_image.draw()
-                    joy_r_image.draw()
-                    win.flip()  
-
-
-                # trial where left joystick will be pushed
-                elif condition == 3:  
-
-                    joy_l_image.size += (x_size_increase, y_size_increase) #enlarge the left joystick
-                    joy_l_image.draw()
-                    joy_r_image.draw()
-                    rect_left_black.draw()
-                    win.flip()
-                    output = wait_joystick_pushed(
-                        joy_r_image,joy_l_image,rect_right_green,rect_left_green,duration=joystick_duration, 
-                        correct_rect='left', rect_left_red=rect_left_red, rect_right_red=rect_right_red, 
-                        joystick_right=joy1, joystick_left=joy2, rect_left_black=rect_left_black, rect_right_black=rect_right_black) # wait for joystick push, lasts 1 seconds
+                        win.flip() # joysticks back to normal size, drawn by autoDraw
+
+
+                    # trial where left joystick will be pushed
+                    elif condition == 3:  
+
+                        joy_l_image.autoDraw = False # joysticks are drawn by the cue background
+                        joy_r_image.autoDraw = False
+                        cue_backgrounds['left'].draw() #enlarged left joystick
+                        win.flip()
+                        output = wait_joystick_pushed(
+                            joy_r_image,joy_l_image,stims.rect_right_green,stims.rect_left_green,duration=joystick_duration, 
+                            correct_rect='left', rect_left_red=stims.rect_left_red, rect_right_red=stims.rect_right_red, 
+                            joystick_right=joy1, joystick_left=joy2, rect_left_black=stims.rect_left_black, rect_right_black=stims.rect_right_black,
+                            background=cue_backgrounds['left'], buffers=trajectory_buffers) # wait for joystick push, lasts 1 seconds
+                        joy_l_image.autoDraw = True
+                        joy_r_image.autoDraw = True
+                        if output == -1: # User hit escape
+                            print('Escape hit - bailing')
+                            return -1
                     
                     
-                    RT_end_right = output['RT_end_right']
-                    RT_end_left = output['RT_end_left']
-                    right_positions = output['right_positions']
-                    left_positions = output['left_positions']
-                    RT_start_right = output['RT_start_right']
-                    RT_start_left = output['RT_start_left']
-                    time = output['time']
-                    if RT_start_left is not None:
-                        RTs += [RT_start_left] # Store RT value to show at the end of the block (we show only the left to avoid potential unlinding/bias from the stimulation, which will target right hand movements)                 
+                        RT_end_right = output['RT_end_right']
+                        RT_end_left = output['RT_end_left']
+                        right_positions = output['right_positions']
+                        left_positions = output['left_positions']
+                        RT_start_right = output['RT_start_right']
+                        RT_start_left = output['RT_start_left']
+                        time = output['time']
+                        if not math.isnan(RT_start_left):
+                            rt_sum += RT_start_left; rt_n += 1 # Store RT value to show at the end of the block (we show only the left to avoid potential unlinding/bias from the stimulation, which will target right hand movements)                 
                     
-                    joy_l_image.size -= (x_size_increase, y_size_increase)
-                    win.flip() 
-                    joy_l_image.draw()
-                    joy_r_image.draw()
-                    win.flip()
+                        win.flip() # joysticks back to normal size, drawn by autoDraw
 
-                else:
-                    buffer=buffer_joystick(joy1, joy2, duration=1) #Buffer to refresh joystick values, lasts 1 seconds
-                    win.flip()
+                    else:
+                        buffer=buffer_joystick(joy1, joy2, duration=1) #Buffer to refresh joystick values, lasts 1 seconds
+                        win.flip()
 
                 
-                isi2 = jitters_2[trial] # Get the jitter for this trial
-                buffer_joystick(joy1, joy2, duration=isi2) # Buffer to refresh joystick values, lasts ~1.5s
-                win.flip()
+                    isi2 = jitters_2[trial] # Get the jitter for this trial
+                    buffer_joystick(joy1, joy2, duration=isi2) # Buffer to refresh joystick values, lasts ~1.5s
+                    win.flip()
 
-                log['RT_press'] = RT_press
-                log['RT_start_right'] = RT_start_right
-                log['RT_start_left'] = RT_start_left
-                log['RT_end_right'] = RT_end_right
-                log['RT_end_left'] = RT_end_left
-                log['right_positions'] = right_positions
-                log['left_positions'] = left_positions
-                log['time'] = time
-
-            else:
-                log['RT_press'] = 'NA'
-                log['RT_end_right'] = 'NA'
-                log['RT_end_left'] = 'NA'
-                log['RT_start_right'] = 'NA'
-                log['RT_start_left'] = 'NA'
-                log['right_positions'] = 'NA'
-                log['left_positions'] = 'NA'
-                log['time'] = 'NA'
+                    trial_RTs = (RT_press, RT_start_right, RT_start_left, RT_end_right, RT_end_left)
+                    trial_positions = (np.asarray(right_positions).tolist(), np.asarray(left_positions).tolist(), np.asarray(time).tolist())
 
+                else:
+                    trial_RTs = (math.nan,)*5 # saved as 'NA'
+                    trial_positions = (math.nan,)*3
 
-            
-            key = event.getKeys()
-            if key and key[0] in ['escape','esc']:
-                print('Escape hit - bailing')
-                return -1
 
-        
-            # Save trial data
-            log['ID'] = params['ID']
-            log['Session'] = params['Session']
-            log['Run'] = params['Run']
-            log['Trial'] = trial+1
-            log['Block'] = block + 1
-
-
-            # Save if not practice run
-            if params['Set'] != 'P':
-                # See if run file already exist
-                if os.path.exists(run_path):
-                    new_file = 0 # Append to file
-                else:
-                    new_file = 1 # Create new file
+            
+                if event.getKeys(keyList=['escape','esc']):
+                    print('Escape hit - bailing')
+                    return -1
 
-                with open(run_path, 'a+') as f:
-                    w = csv.DictWriter(f, log.keys(),lineterminator = '\n')
-                    if new_file == 1:
-                        w.writeheader()
-                    w.writerow(log)      
         
+                # Save trial data
+                rows[trial] = (params['ID'], params['Session'], params['Run'], trial+1, block+1, t1) + trial_RTs + trial_positions
+                n_done = trial + 1
+        finally:
+            # Save if not practice run, header only if the run file didn't exist yet
+            # Also runs on an escape or an error, so the completed trials of the block are kept
+            if save_trials:
+                save_rows(rows[:n_done], run_path, need_header)
+                need_header = False
 
         joy_l_image.autoDraw = False
         joy_r_image.autoDraw = False
         #send_trigger(3) #end of block
-        RT_message=visual.TextStim(win,text=f"Average Reaction Time: {np.round(np.nanmean(RTs),3)}",pos=(0,0),color=(-1,-1,-1),height=0.05,bold=True)
-        win.flip()
-        RT_message.draw()
+        average_RT = rt_sum/rt_n if rt_n else float('nan')
+        stims.RT_message.text = f"Average Reaction Time: {average_RT:.3f}"
         win.flip()
-        core.wait(RT_display_time)
+        if wait_frames(int(round(RT_display_time * refresh_rate)), win, stims.RT_message):
+            print('Escape hit - bailing')
+            return -1
         # Break period
         if block < nb_blocks - 1: # If not the last block
             
-            break_message = visual.TextStim(win, text="BREAK", pos=(0, 0), color=(-1, -1, -1), height=0.05, bold=True)
-            break_message.autoDraw = True
+            stims.break_message.autoDraw = True
 
             TI_countdown(win, t=25) # Break period
-            break_message.autoDraw = False
+            stims.break_message.autoDraw = False
             win.flip()
 
     # End of task
     if params['Set'] != 'P':
-        end_message = visual.TextStim(win, text="End of task. Thank you for your participation!", pos=(0, 0), color=(-1, -1, -1), height=0.05, bold=True)
-        end_message.draw()
-        win.flip()
-        core.wait(RT_display_time)  # Wait before closing
+        if wait_frames(int(round(RT_display_time * refresh_rate)), win, stims.end_message): # Wait before closing
+            print('Escape hit - bailing')
+            return -1
     
 
     return 0
@@ -880,38 +1098,34 @@ elif params['Randomization']==0:
     seed = None
 else:
     seed = params['Randomization']
-np.random.seed(seed)
+rng = np.random.default_rng(seed) #all the task randomness is drawn from this generator
 
 params['TimeStarted'] = str(datetime.now())
 
 ### Creating task parameters log file
-subject_path = 'Data\\Subject_'+str(params['ID'])
-params_path = subject_path+'\\S_'+str(params['ID'])+'_PMBR_task_params.csv'
-run_path = subject_path+'\\S_'+str(params['ID'])+'_PMBR_runs.csv'
-subject_path = Path(subject_path); 
-params_path = Path(params_path); 
-run_path = Path(run_path); 
+subject_path = Path('Data') / f"Subject_{params['ID']}"
+params_path = subject_path / f"S_{params['ID']}_PMBR_task_params.csv"
+run_path = subject_path / f"S_{params['ID']}_PMBR_runs.csv"
 
 # Create subject path if there isn't one
-if not os.path.exists(subject_path):
-    os.makedirs(subject_path)
+subject_path.mkdir(parents=True, exist_ok=True)
 
-# See if task files already exist
-if os.path.exists(params_path):
-    new_file = 0 # Append to file
-else:
-    new_file = 1 # Create new file
+# See if task files already exist, header only for a new file
+new_file = not params_path.exists()
 
-with open(params_path, 'a+') as f:
+with params_path.open('a') as f:
     w = csv.DictWriter(f, params.keys(),lineterminator = '\n')
-    if new_file == 1:
+    if new_file:
         w.writeheader()
     w.writerow(params)
 
 
 #create window
 win = visual.Window(fullscr=True,monitor='testMonitor',screen=1,units="height",color=[-0.5,-0.5,-0.5])
-print(f"RefreshRate: {win.getActualFrameRate()} Hz")
+win.winHandle.push_handlers(key_state) #keyboard state for the escape key checks
+warm_up_scan_axes() #compile before the first trial
+refresh_rate = win.getActualFrameRate() or expected_refresh_rate # None if the measure is unstable
+print(f"RefreshRate: {refresh_rate} Hz")
 
 #load conditions
 conditions_df = pd.read_csv('trial_conditions.csv')